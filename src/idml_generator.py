@@ -1,19 +1,261 @@
-import json
+import contextlib
+import functools
+import io
 import os
-from typing import Dict, List, Any, Tuple
-import tempfile
-import shutil
+from pathlib import Path
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
+from typing import DefaultDict, Dict, List, Any, Optional, Sequence, Tuple, Union
 import zipfile
 import math
 import re
+import traceback
+
+# Faster JSON parsing when orjson is installed (optional), stdlib otherwise
+try:
+    from orjson import loads as _json_loads
+except ImportError:
+    from json import loads as _json_loads
+
+# designmap.xml spread references, stripped before the generated spreads are registered
+_SPREAD_SRC_RE = re.compile(r'\s*<idPkg:Spread[^>]*src="Spreads/[^"]*"[^>]*/?>\s*')
+
+# Directories searched for the example JSON files, most likely first
+JSON_SEARCH_DIRS = (Path("examples"), Path("../examples"), Path("src/examples"))
+
+# Last used output index, persisted in the build directory as
+# "<OUTPUT_SEQ_FILENAME>.<base name>" (one file per base name)
+OUTPUT_SEQ_FILENAME = ".idml_seq"
+
+# Example JSON file per test type (command line flag without the dash)
+EXAMPLE_JSON_FILES = {
+    "one": "onePage.json",
+    "two": "twoPages.json",
+    "three": "threePages.json",
+    "four": "fourPages.json",
+}
+
+# Resolved example JSON path per test type
+_json_path_cache: Dict[str, Path] = {}
+
+# TextFrame Y positions by story index, identical on every page
+_BASE_Y_LIST = (
+    -326.83464566890945,
+    -210.61417322872836,
+    -94.39370078854728,
+    21.826771651633806,
+    138.0472440918149,
+    254.26771653199575,  # Extra positions for more sections
+)
+_BASE_Y_STR = [repr(y) for y in _BASE_Y_LIST]
+
+# Formatted Y positions for story indexes past _BASE_Y_LIST
+_extra_y_str_cache: Dict[int, str] = {}
+
+# Entity escapes plus removal of control characters not allowed in XML (keeps \t \n \r)
+_XML_ESCAPE = str.maketrans(
+    {
+        "&": "&amp;",
+        "<": "&lt;",
+        ">": "&gt;",
+        '"': "&quot;",
+        "'": "&apos;",
+        **{chr(i): None for i in range(32) if i not in (9, 10, 13)},
+    }
+)
+
+# Errors expected while assembling an IDML package (I/O, bad template, bad input data)
+_GENERATION_ERRORS = (OSError, KeyError, ValueError, zipfile.BadZipFile)
+
+# Fixed IDs of the first two objects of each kind (taken from the template),
+# later ones are numbered from the kind's offset
+_ID_TABLES = {
+    "spread": {1: "ucf", 2: "u109"},
+    "story": {1: "ue5", 2: "u112"},
+    "page": {1: "ud4", 2: "u10e"},
+    "textframe": {1: "uf7", 2: "u10f"},
+}
+_ID_OFFSETS = {"spread": 100, "story": 100, "page": 200, "textframe": 300}
+
+# Generated members smaller than this are written uncompressed
+_STORED_MAX_SIZE = 4096
+
+# XML templates for generated spreads, stories and TextFrames (filled with str.format)
+_SPREAD_HEADER_TMPL = """<?xml version="1.0" encoding="UTF-8" standalone="yes"?>
+<idPkg:Spread xmlns:idPkg="http://ns.adobe.com/AdobeInDesign/idml/1.0/packaging" DOMVersion="20.4">
+\t<Spread Self="{spread_id}" FlattenerOverride="Default" SpreadHidden="false" AllowPageShuffle="true" ItemTransform="{item_transform}" ShowMasterItems="true" PageCount="{page_count}" BindingLocation="{binding_location}" PageTransitionType="None" PageTransitionDirection="NotApplicable" PageTransitionDuration="Medium">
+\t\t<FlattenerPreference LineArtAndTextResolution="300" GradientAndMeshResolution="150" ClipComplexRegions="false" ConvertAllStrokesToOutlines="false" ConvertAllTextToOutlines="false">
+\t\t\t<Properties>
+\t\t\t\t<RasterVectorBalance type="double">50</RasterVectorBalance>
+\t\t\t</Properties>
+\t\t</FlattenerPreference>"""
+
+_PAGE_TMPL = """
+\t\t<Page Self="{page_id}" AppliedAlternateLayout="ub4" LayoutRule="{layout_rule}" SnapshotBlendingMode="IgnoreLayoutSnapshots" OptionalPage="false" GeometricBounds="0 0 {page_height} {page_width}" ItemTransform="{page_transform}" Name="{page_num}" AppliedTrapPreset="TrapPreset/$ID/kDefaultTrapStyleName" OverrideList="" AppliedMaster="{applied_master}" MasterPageTransform="1 0 0 1 0 0" TabOrder="" GridStartingPoint="TopOutside" UseMasterGrid="true">
+\t\t\t<Properties>
+\t\t\t\t<Descriptor type="list">
+\t\t\t\t\t<ListItem type="string"></ListItem>
+\t\t\t\t\t<ListItem type="enumeration">Arabic</ListItem>
+\t\t\t\t\t<ListItem type="boolean">true</ListItem>
+\t\t\t\t\t<ListItem type="boolean">false</ListItem>
+\t\t\t\t\t<ListItem type="long">{page_num}</ListItem>
+\t\t\t\t\t<ListItem type="long">{page_num}</ListItem>
+\t\t\t\t\t<ListItem type="string"></ListItem>
+\t\t\t\t</Descriptor>
+\t\t\t\t<PageColor type="enumeration">UseMasterColor</PageColor>
+\t\t\t</Properties>
+\t\t\t<MarginPreference ColumnCount="1" ColumnGutter="12" Top="36" Bottom="36" Left="36" Right="36" ColumnDirection="Horizontal" ColumnsPositions="0 523.275590551" />
+\t\t\t<GridDataInformation FontStyle="Regular" PointSize="12" CharacterAki="0" LineAki="9" HorizontalScale="100" VerticalScale="100" LineAlignment="LeftOrTopLineJustify" GridAlignment="AlignEmCenter" CharacterAlignment="AlignEmCenter">
+\t\t\t\t<Properties>
+\t\t\t\t\t<AppliedFont type="string">Minion Pro</AppliedFont>
+\t\t\t\t</Properties>
+\t\t\t</GridDataInformation>
+\t\t</Page>"""
+
+_SPREAD_FOOTER = """
+\t</Spread>
+</idPkg:Spread>"""
+
+_TITLE_PARAGRAPH_TMPL = """
+\t\t<ParagraphStyleRange AppliedParagraphStyle="ParagraphStyle/$ID/NormalParagraphStyle">
+\t\t\t<CharacterStyleRange AppliedCharacterStyle="CharacterStyle/$ID/[No character style]" FontStyle="Bold" PointSize="14">
+\t\t\t\t<Content>{content}</Content>
+\t\t\t</CharacterStyleRange>
+\t\t</ParagraphStyleRange>"""
+
+_TEXT_PARAGRAPH_TMPL = """
+\t\t<ParagraphStyleRange AppliedParagraphStyle="ParagraphStyle/$ID/NormalParagraphStyle">
+\t\t\t<CharacterStyleRange AppliedCharacterStyle="CharacterStyle/$ID/[No character style]" PointSize="12">
+\t\t\t\t<Content>{content}</Content>
+\t\t\t</CharacterStyleRange>
+\t\t</ParagraphStyleRange>"""
+
+_STORY_TMPL = """<?xml version="1.0" encoding="UTF-8" standalone="yes"?>
+<idPkg:Story xmlns:idPkg="http://ns.adobe.com/AdobeInDesign/idml/1.0/packaging" DOMVersion="20.4">
+\t<Story Self="{story_id}" AppliedTOCStyle="n" UserText="true" IsEndnoteStory="false" TrackChanges="false" StoryTitle="$ID/" AppliedNamedGrid="n">
+\t\t<StoryPreference OpticalMarginAlignment="false" OpticalMarginSize="12" FrameType="TextFrameType" StoryOrientation="Horizontal" StoryDirection="LeftToRightDirection" />
+\t\t<InCopyExportOption IncludeGraphicProxies="true" IncludeAllResources="false" />{content}
+\t</Story>
+</idPkg:Story>"""
+
+_PATH_TMPL = """\t\t\t\t\t\t\t<PathPointType Anchor="{left} -{ah}" LeftDirection="{left} -{ah}" RightDirection="{left} -{ah}" />
+\t\t\t\t\t\t\t<PathPointType Anchor="{left} {ah}" LeftDirection="{left} {ah}" RightDirection="{left} {ah}" />
+\t\t\t\t\t\t\t<PathPointType Anchor="{right} {ah}" LeftDirection="{right} {ah}" RightDirection="{right} {ah}" />
+\t\t\t\t\t\t\t<PathPointType Anchor="{right} -{ah}" LeftDirection="{right} -{ah}" RightDirection="{right} -{ah}" />"""
+
+# Invariant parts of the TextFrame markup, shared by every generated frame
+_TEXTFRAME_ATTRS = 'PreviousTextFrame="n" NextTextFrame="n" ContentType="TextType" ParentInterfaceChangeCount="" TargetInterfaceChangeCount="" LastUpdatedInterfaceChangeCount="" OverriddenPageItemProps="" HorizontalLayoutConstraints="FlexibleDimension FixedDimension FlexibleDimension" VerticalLayoutConstraints="FlexibleDimension FixedDimension FlexibleDimension" GradientFillStart="0 0" GradientFillLength="0" GradientFillAngle="0" GradientStrokeStart="0 0" GradientStrokeLength="0" GradientStrokeAngle="0" ItemLayer="uba" Locked="false" LocalDisplaySetting="Default" GradientFillHiliteLength="0" GradientFillHiliteAngle="0" GradientStrokeHiliteLength="0" GradientStrokeHiliteAngle="0" AppliedObjectStyle="ObjectStyle/$ID/[Normal Text Frame]" Visible="true" Name="$ID/"'
+_TEXTFRAME_SUFFIX = """
+\t\t\t\t<Properties>
+\t\t\t\t\t<InsetSpacing type="list">
+\t\t\t\t\t\t<ListItem type="unit">0</ListItem>
+\t\t\t\t\t\t<ListItem type="unit">0</ListItem>
+\t\t\t\t\t\t<ListItem type="unit">0</ListItem>
+\t\t\t\t\t\t<ListItem type="unit">0</ListItem>
+\t\t\t\t\t</InsetSpacing>
+\t\t\t\t</Properties>
+\t\t\t</TextFramePreference>
+\t\t\t<TextWrapPreference Inverse="false" ApplyToMasterPageOnly="false" TextWrapSide="BothSides" TextWrapMode="None">
+\t\t\t\t<Properties>
+\t\t\t\t\t<TextWrapOffset Top="0" Left="0" Bottom="0" Right="0" />
+\t\t\t\t</Properties>
+\t\t\t</TextWrapPreference>
+\t\t\t<ObjectExportOption EpubType="$ID/" SizeType="DefaultSize" CustomSize="$ID/" PreserveAppearanceFromLayout="PreserveAppearanceDefault" AltTextSourceType="SourceXMLStructure" ActualTextSourceType="SourceXMLStructure" CustomAltText="$ID/" CustomActualText="$ID/" ApplyTagType="TagFromStructure" ImageConversionType="JPEG" ImageExportResolution="Ppi300" GIFOptionsPalette="AdaptivePalette" GIFOptionsInterlaced="true" JPEGOptionsQuality="High" JPEGOptionsFormat="BaselineEncoding" ImageAlignment="AlignLeft" ImageSpaceBefore="0" ImageSpaceAfter="0" UseImagePageBreak="false" ImagePageBreak="PageBreakBefore" CustomImageAlignment="false" SpaceUnit="CssPixel" CustomLayout="false" CustomLayoutType="AlignmentAndSpacing">
+\t\t\t\t<Properties>
+\t\t\t\t\t<AltMetadataProperty NamespacePrefix="$ID/" PropertyPath="$ID/" />
+\t\t\t\t\t<ActualMetadataProperty NamespacePrefix="$ID/" PropertyPath="$ID/" />
+\t\t\t\t</Properties>
+\t\t\t</ObjectExportOption>
+\t\t</TextFrame>"""
+
+_TEXTFRAME_TMPL = (
+    '<TextFrame Self="{frame_id}" ParentStory="{story_id}" '
+    + _TEXTFRAME_ATTRS
+    + ' ItemTransform="1 0 0 1 {x} {y}">'
+    + """
+\t\t\t<Properties>
+\t\t\t\t<PathGeometry>
+\t\t\t\t\t<GeometryPathType PathOpen="false">
+\t\t\t\t\t\t<PathPointArray>
+{path_points}
+\t\t\t\t\t\t</PathPointArray>
+\t\t\t\t\t</GeometryPathType>
+\t\t\t\t</PathGeometry>
+\t\t\t</Properties>
+\t\t\t<TextFramePreference TextColumnCount="1" TextColumnFixedWidth="{width}" TextColumnMaxWidth="0">"""
+    + _TEXTFRAME_SUFFIX
+)
+
+
+@functools.lru_cache(maxsize=4)
+def _textframe_path_points(width: float, height: float) -> str:
+    """PathPointType lines of a TextFrame; they depend only on the frame size."""
+    # Use the exact structure from fixed version analysis
+    ah = height * 0.5
+
+    # Fixed version uses specific anchor values for wider frames
+    if width == 523.275590551:  # Fixed version width
+        left_anchor = -254.12598425187792
+        right_anchor = 269.1496062991221
+    else:
+        # Fallback to original calculation
+        aw = width * 0.5
+        left_anchor = -aw
+        right_anchor = aw
+
+    return _PATH_TMPL.format(left=left_anchor, right=right_anchor, ah=ah)
+
+
+@functools.lru_cache(maxsize=None)
+def _locate_base_template(cwd: str) -> str:
+    """Absolute path of the template IDML, probed once per working directory."""
+    template_paths = [
+        "../template/template.idml",
+        "template/template.idml",
+        "template.idml",
+    ]
+
+    for template_path in template_paths:
+        path = os.path.join(cwd, template_path)
+        if os.path.exists(path):
+            return os.path.abspath(path)
+
+    # Not cached: the template may still be created later
+    raise FileNotFoundError("Arquivo IDML de template não encontrado.")
 
 
 class EnhancedIDMLGenerator:
 
-    def __init__(self):
-        self.temp_dir = None
+    __slots__ = (
+        "base_idml_path",
+        "compresslevel",
+        "build_dir",
+        "output_counters",
+        "debug",
+        "page_width",
+        "page_height",
+        "margin",
+        "frame_width",
+        "frame_height",
+        "frame_spacing_y",
+        "page1_x",
+        "page2_x",
+        "page1_y",
+        "page2_y",
+        "id_counters",
+    )
+
+    def __init__(self, compresslevel: int = 1):
         self.base_idml_path = None
-        self.output_counter = 1
+
+        # Deflate level for the IDML package (1 = fastest, 9 = smallest)
+        self.compresslevel = compresslevel
+        self.build_dir = None
+        # Next output index per base name, seeded from the build directory
+        self.output_counters: Dict[str, int] = {}
+
+        # Print full tracebacks on generation errors (set IDML_DEBUG=1)
+        self.debug = bool(os.environ.get("IDML_DEBUG"))
 
         # Layout configuration
         self.page_width = 595.2755905509999
@@ -32,85 +274,94 @@ class EnhancedIDMLGenerator:
         self.page2_y = -306.14173228231886
 
         # ID generation counters
-        self.spread_counter = 1
-        self.story_counter = 1
-        self.page_counter = 1
-
-    def _generate_spread_id(self) -> str:
-        if self.spread_counter == 1:
-            return "ucf"
-        elif self.spread_counter == 2:
-            return "u109"
-        else:
-            # For additional spreads, generate similar IDs
-            return f"u{100 + self.spread_counter:03d}"
-
-    def _generate_story_id(self) -> str:
-        if self.story_counter == 1:
-            story_id = "ue5"
-        elif self.story_counter == 2:
-            story_id = "u112"
-        else:
-            story_id = f"u{100 + self.story_counter:03d}"
+        self.id_counters: Dict[str, int] = {"spread": 1, "story": 1, "page": 1}
 
-        return story_id
+    def _format_id(self, kind: str, counter: int) -> str:
+        return _ID_TABLES[kind].get(counter) or f"u{_ID_OFFSETS[kind] + counter:03d}"
 
-    def _generate_page_id(self) -> str:
-        if self.page_counter == 1:
-            return "ud4"
-        elif self.page_counter == 2:
-            return "u10e"
-        else:
-            # For additional pages, generate similar IDs
-            return f"u{200 + self.page_counter:03d}"
+    def _next_id(self, kind: str) -> str:
+        """Return the next ID of the given kind and advance its counter."""
+        counter = self.id_counters[kind]
+        self.id_counters[kind] = counter + 1
+        return self._format_id(kind, counter)
 
     def _generate_textframe_id(self) -> str:
-        if self.page_counter == 1:
-            return "uf7"
-        elif self.page_counter == 2:
-            return "u10f"
-        else:
-            # For additional textframes, generate similar IDs
-            return f"u{300 + self.page_counter:03d}"
+        # TextFrame IDs follow the page counter, they have no counter of their own
+        return self._format_id("textframe", self.id_counters["page"])
 
     def _get_next_output_filename(self, base_name: str = "enhanced") -> str:
         """Get the next available output filename."""
-        # Use the same logic as the original generator
-        if os.path.exists("../build"):
-            build_dir = "../build"
-        elif os.path.exists("build"):
-            build_dir = "build"
-        else:
-            if os.path.exists("src"):
+        if self.build_dir is None:
+            # Use the same logic as the original generator
+            if os.path.exists("../build"):
+                build_dir = "../build"
+            elif os.path.exists("build"):
                 build_dir = "build"
             else:
-                build_dir = "../build"
-
-        os.makedirs(build_dir, exist_ok=True)
-
-        while True:
-            filename = f"{base_name}-{self.output_counter}.idml"
-            file_path = os.path.join(build_dir, filename)
+                if os.path.exists("src"):
+                    build_dir = "build"
+                else:
+                    build_dir = "../build"
 
-            if not os.path.exists(file_path):
-                self.output_counter += 1
-                return file_path
+            os.makedirs(build_dir, exist_ok=True)
+            self.build_dir = build_dir
 
-            self.output_counter += 1
+        counter = self.output_counters.get(base_name)
+        if counter is None:
+            last_counter = self._read_output_seq(base_name)
+            if last_counter is not None:
+                counter = last_counter + 1
+            else:
+                # No recorded index yet: scan once, continue after the highest index
+                name_pattern = re.compile(rf"{re.escape(base_name)}-(\d+)\.idml")
+                counter = 1
+                with os.scandir(self.build_dir) as it:
+                    for entry in it:
+                        match = name_pattern.fullmatch(entry.name)
+                        if match:
+                            counter = max(counter, int(match.group(1)) + 1)
+
+        # Never overwrite a file the sequence doesn't know about
+        output_path = os.path.join(self.build_dir, f"{base_name}-{counter}.idml")
+        while os.path.exists(output_path):
+            counter += 1
+            output_path = os.path.join(self.build_dir, f"{base_name}-{counter}.idml")
+
+        # Reserved for this process only; _write_output_seq records it on disk
+        # once the package has actually been published
+        self.output_counters[base_name] = counter + 1
+        return output_path
+
+    def _output_seq_path(self, base_name: str) -> str:
+        return os.path.join(self.build_dir, f"{OUTPUT_SEQ_FILENAME}.{base_name}")
+
+    def _read_output_seq(self, base_name: str) -> Optional[int]:
+        """Last used output index of a base name, None if not recorded or invalid."""
+        try:
+            with open(self._output_seq_path(base_name), "rb") as seq_file:
+                counter = int(seq_file.read())
+        except (OSError, ValueError):
+            return None
+        return counter if counter >= 0 else None
+
+    def _write_output_seq(self, base_name: str) -> None:
+        """Persist the last output index reserved for base_name."""
+        seq_path = self._output_seq_path(base_name)
+
+        # Replace atomically so a concurrent reader never sees a partial file;
+        # the temp name is per process so parallel generators don't collide
+        tmp_path = f"{seq_path}.{os.getpid()}.tmp"
+        try:
+            with open(tmp_path, "w", encoding="utf-8") as seq_file:
+                seq_file.write(str(self.output_counters[base_name] - 1))
+            os.replace(tmp_path, seq_path)
+        except OSError as e:
+            # The package is already published; the next run just rescans
+            print(f"⚠️  Não foi possível salvar a sequência de saída: {e}")
 
     def _find_base_template(self) -> str:
         """Find the base template IDML file"""
-        template_paths = [
-            "../template/template.idml",
-            "template/template.idml",
-            "template.idml",
-        ]
-
-        for template_path in template_paths:
-            if os.path.exists(template_path):
-                return os.path.abspath(template_path)
-
-        raise FileNotFoundError("Arquivo IDML de template não encontrado.")
+        return _locate_base_template(os.getcwd())
 
     """
         Calculate X,Y coordinates for any page number based on template.
@@ -154,8 +405,41 @@ class EnhancedIDMLGenerator:
             # First spread has 1 page, remaining spreads have 2 pages each
             return 1 + math.ceil((total_pages - 1) / 2)
 
+    def _plan_layout(self, total_pages: int) -> List[Dict[str, Any]]:
+        """Compute ID, position and spread of every page in a single pass."""
+        layout = []
+        for page_num in range(1, total_pages + 1):
+            x_pos, y_pos = self._calculate_page_position(page_num)
+
+            # Determine layout rule and applied master
+            if page_num == 1:
+                layout_rule = "Off"  # Based on fixed structure
+                applied_master = "ubb"  # Based on fixed structure
+            else:
+                layout_rule = "UseMaster" if page_num == 2 else "Off"
+                applied_master = "ubb"
+
+            layout.append(
+                {
+                    "page_num": page_num,
+                    "page_id": self._next_id("page"),
+                    # Use calculated positions for ItemTransform
+                    "page_transform": f"1 0 0 1 {x_pos} {y_pos}",
+                    "layout_rule": layout_rule,
+                    "applied_master": applied_master,
+                    # Spread 0: page 1 only, spread N: pages 2N and 2N+1
+                    "spread_index": page_num // 2,
+                }
+            )
+
+        return layout
+
     def _create_spread_xml(
-        self, spread_id: str, spread_index: int, pages_in_spread: List[int]
+        self,
+        spread_id: str,
+        spread_index: int,
+        pages_in_spread: List[Dict[str, Any]],
+        textframe_blocks: Sequence[str] = (),
     ) -> str:
         """
         Create proper XML for a new spread based on fixed structure analysis.
@@ -171,160 +455,114 @@ class EnhancedIDMLGenerator:
             item_transform = f"1 0 0 1 0 {y_offset}"
             binding_location = 1
 
-        spread_xml = f"""<?xml version="1.0" encoding="UTF-8" standalone="yes"?>
-<idPkg:Spread xmlns:idPkg="http://ns.adobe.com/AdobeInDesign/idml/1.0/packaging" DOMVersion="20.4">
-\t<Spread Self="{spread_id}" FlattenerOverride="Default" SpreadHidden="false" AllowPageShuffle="true" ItemTransform="{item_transform}" ShowMasterItems="true" PageCount="{len(pages_in_spread)}" BindingLocation="{binding_location}" PageTransitionType="None" PageTransitionDirection="NotApplicable" PageTransitionDuration="Medium">
-\t\t<FlattenerPreference LineArtAndTextResolution="300" GradientAndMeshResolution="150" ClipComplexRegions="false" ConvertAllStrokesToOutlines="false" ConvertAllTextToOutlines="false">
-\t\t\t<Properties>
-\t\t\t\t<RasterVectorBalance type="double">50</RasterVectorBalance>
-\t\t\t</Properties>
-\t\t</FlattenerPreference>"""
+        spread_parts = [
+            _SPREAD_HEADER_TMPL.format(
+                spread_id=spread_id,
+                item_transform=item_transform,
+                page_count=len(pages_in_spread),
+                binding_location=binding_location,
+            )
+        ]
 
         # Add each page to the spread
-        for page_num in pages_in_spread:
-            x_pos, y_pos = self._calculate_page_position(page_num)
-            page_id = self._generate_page_id()
-            self.page_counter += 1
-
-            # Use calculated positions for ItemTransform
-            page_transform = f"1 0 0 1 {x_pos} {y_pos}"
-
-            # Determine layout rule and applied master
-            if page_num == 1:
-                layout_rule = "Off"  # Based on fixed structure
-                applied_master = "ubb"  # Based on fixed structure
-            else:
-                layout_rule = "UseMaster" if page_num == 2 else "Off"
-                applied_master = "ubb"
-
-            page_xml = f"""
-\t\t<Page Self="{page_id}" AppliedAlternateLayout="ub4" LayoutRule="{layout_rule}" SnapshotBlendingMode="IgnoreLayoutSnapshots" OptionalPage="false" GeometricBounds="0 0 {self.page_height} {self.page_width}" ItemTransform="{page_transform}" Name="{page_num}" AppliedTrapPreset="TrapPreset/$ID/kDefaultTrapStyleName" OverrideList="" AppliedMaster="{applied_master}" MasterPageTransform="1 0 0 1 0 0" TabOrder="" GridStartingPoint="TopOutside" UseMasterGrid="true">
-\t\t\t<Properties>
-\t\t\t\t<Descriptor type="list">
-\t\t\t\t\t<ListItem type="string"></ListItem>
-\t\t\t\t\t<ListItem type="enumeration">Arabic</ListItem>
-\t\t\t\t\t<ListItem type="boolean">true</ListItem>
-\t\t\t\t\t<ListItem type="boolean">false</ListItem>
-\t\t\t\t\t<ListItem type="long">{page_num}</ListItem>
-\t\t\t\t\t<ListItem type="long">{page_num}</ListItem>
-\t\t\t\t\t<ListItem type="string"></ListItem>
-\t\t\t\t</Descriptor>
-\t\t\t\t<PageColor type="enumeration">UseMasterColor</PageColor>
-\t\t\t</Properties>
-\t\t\t<MarginPreference ColumnCount="1" ColumnGutter="12" Top="36" Bottom="36" Left="36" Right="36" ColumnDirection="Horizontal" ColumnsPositions="0 523.275590551" />
-\t\t\t<GridDataInformation FontStyle="Regular" PointSize="12" CharacterAki="0" LineAki="9" HorizontalScale="100" VerticalScale="100" LineAlignment="LeftOrTopLineJustify" GridAlignment="AlignEmCenter" CharacterAlignment="AlignEmCenter">
-\t\t\t\t<Properties>
-\t\t\t\t\t<AppliedFont type="string">Minion Pro</AppliedFont>
-\t\t\t\t</Properties>
-\t\t\t</GridDataInformation>
-\t\t</Page>"""
-            spread_xml += page_xml
-
-        spread_xml += """
-\t</Spread>
-</idPkg:Spread>"""
-
-        return spread_xml
-
-    """Update designmap.xml to replace all spread references with new ones."""
-
-    def _update_designmap_for_new_spreads(
-        self, extract_dir: str, new_spreads: List[str]
-    ) -> bool:
-
-        try:
-            designmap_path = os.path.join(extract_dir, "designmap.xml")
-
-            if not os.path.exists(designmap_path):
-                print("⚠️  designmap.xml não encontrado")
-                return False
-
-            # Read current designmap
-            with open(designmap_path, "r", encoding="utf-8") as f:
-                designmap_content = f.read()
-
-            # Remove all existing spread references
-            spread_pattern = r'\s*<idPkg:Spread[^>]*src="Spreads/[^"]*"[^>]*/?>\s*'
-            designmap_content = re.sub(spread_pattern, "", designmap_content)
-
-            # Add new spread entries
-            new_spread_entries = []
-            for spread_file in new_spreads:
-                spread_entry = f'\n\t<idPkg:Spread src="Spreads/{spread_file}" />'
-                new_spread_entries.append(spread_entry)
-
-            # Insert new entries before the closing tag
-            if "</Document>" in designmap_content:
-                insert_point = designmap_content.rfind("</Document>")
-                new_content = (
-                    designmap_content[:insert_point]
-                    + "".join(new_spread_entries)
-                    + "\n"
-                    + designmap_content[insert_point:]
+        page_height = self.page_height
+        page_width = self.page_width
+        for page in pages_in_spread:
+            spread_parts.append(
+                _PAGE_TMPL.format(
+                    page_height=page_height, page_width=page_width, **page
                 )
+            )
 
-                with open(designmap_path, "w", encoding="utf-8") as f:
-                    f.write(new_content)
+        # TextFrames go after the pages, just before the closing tag
+        spread_parts.extend(textframe_blocks)
+        spread_parts.append(_SPREAD_FOOTER)
 
-                # print(f"✅ Updated designmap.xml with {len(new_spreads)} dynamic spread references")
-                return True
+        return "".join(spread_parts)
 
-            return False
+    """Update designmap.xml: replace spread references and register the new stories."""
 
-        except Exception as e:
-            print(f"❌ Error updating designmap: {e}")
-            return False
+    def _rewrite_designmap(
+        self,
+        designmap_content: str,
+        new_spreads: List[str],
+        stories: List[Dict[str, str]],
+    ) -> str:
+
+        # Remove all existing spread references
+        designmap_content = _SPREAD_SRC_RE.sub("", designmap_content)
+
+        prefix, closing_tag, suffix = designmap_content.rpartition("</Document>")
+        if not closing_tag:
+            return designmap_content
+
+        # New spread entries, then story entries, before the closing tag
+        parts = [prefix]
+        parts.extend(
+            f'\n\t<idPkg:Spread src="Spreads/{spread_file}" />'
+            for spread_file in new_spreads
+        )
+        parts.append("\n")
+        parts.extend(
+            f'\n\t<idPkg:Story src="Stories/Story_{story_data["story_id"]}.xml" />'
+            for story_data in stories
+        )
+        parts += ("\n", closing_tag, suffix)
+
+        # print(f"✅ Updated designmap.xml with {len(new_spreads)} spreads and {len(stories)} stories")
+        return "".join(parts)
 
     """Create stories from JSON pages - one story per SECTION, not per page."""
 
     def _create_stories_from_pages(
-        self, json_data: Dict[str, Any]
+        self, pages: Sequence[Dict[str, Any]]
     ) -> List[Dict[str, str]]:
-        stories = []
-
-        if "pages" in json_data:
-            for page_num, page in enumerate(json_data["pages"], 1):
-                if "sections" in page:
-                    # Create one story for EACH section
-                    for section_idx, section in enumerate(page["sections"]):
-                        story_id = self._generate_story_id()
-                        # print(f"🔍 Creating story {len(stories)+1}: {story_id} (counter={self.story_counter})")
-                        self.story_counter += 1
-
-                        title = section.get("title", "").strip()
-                        text = section.get("text", "").strip()
-                        
-                        # Skip sections that have neither title nor text
-                        if not title and not text:
-                            continue
-                            
-                        # Create combined content text for display purposes
-                        content_parts = []
-                        if title:
-                            content_parts.append(title)
-                        if text:
-                            content_parts.append(text)
-                        content_text = "  ".join(content_parts)
-
-                        story_xml = self._create_story_with_content(
-                            story_id, title, text
-                        )
-
-                        stories.append(
-                            {
-                                "story_id": story_id,
-                                "content_text": content_text,
-                                "story_xml": story_xml,
-                                "page_number": page_num,
-                                "section_index": section_idx,
-                                "title": title,
-                                "text": text,
-                            }
-                        )
+        create_story = self._create_story_for_section
+
+        # Create one story for EACH section
+        stories = [
+            story
+            for page_num, page in enumerate(pages, 1)
+            for section_idx, section in enumerate(page.get("sections") or ())
+            if (story := create_story(page_num, section_idx, section)) is not None
+        ]
 
         # print(f"📊 Total stories created: {len(stories)}")
         return stories
 
+    def _create_story_for_section(
+        self, page_num: int, section_idx: int, section: Dict[str, Any]
+    ) -> Optional[Dict[str, str]]:
+        """Build the story for one section, or None if the section is empty."""
+        story_id = self._next_id("story")
+
+        title = section.get("title", "").strip()
+        text = section.get("text", "").strip()
+
+        # Skip sections that have neither title nor text
+        if not title and not text:
+            return None
+
+        # Create combined content text for display purposes
+        content_parts = []
+        if title:
+            content_parts.append(title)
+        if text:
+            content_parts.append(text)
+        content_text = "  ".join(content_parts)
+
+        story_xml = self._create_story_with_content(story_id, title, text)
+
+        return {
+            "story_id": story_id,
+            "content_text": content_text,
+            "story_xml": story_xml,
+            "page_number": page_num,
+            "section_index": section_idx,
+            "title": title,
+            "text": text,
+        }
+
     def _create_story_with_content(self, story_id: str, title: str, text: str) -> str:
         """Create Story XML with separated title and text content with proper formatting."""
         escaped_title = self._escape_xml_content(title) if title else ""
@@ -335,38 +573,17 @@ class EnhancedIDMLGenerator:
         
         # Add title with bold formatting if it exists
         if escaped_title:
-            story_content.append(f"""
-\t\t<ParagraphStyleRange AppliedParagraphStyle="ParagraphStyle/$ID/NormalParagraphStyle">
-\t\t\t<CharacterStyleRange AppliedCharacterStyle="CharacterStyle/$ID/[No character style]" FontStyle="Bold" PointSize="14">
-\t\t\t\t<Content>{escaped_title}</Content>
-\t\t\t</CharacterStyleRange>
-\t\t</ParagraphStyleRange>""")
+            story_content.append(_TITLE_PARAGRAPH_TMPL.format(content=escaped_title))
         
         # Add text with normal formatting if it exists
         if escaped_text:
-            story_content.append(f"""
-\t\t<ParagraphStyleRange AppliedParagraphStyle="ParagraphStyle/$ID/NormalParagraphStyle">
-\t\t\t<CharacterStyleRange AppliedCharacterStyle="CharacterStyle/$ID/[No character style]" PointSize="12">
-\t\t\t\t<Content>{escaped_text}</Content>
-\t\t\t</CharacterStyleRange>
-\t\t</ParagraphStyleRange>""")
+            story_content.append(_TEXT_PARAGRAPH_TMPL.format(content=escaped_text))
 
-        return f"""<?xml version="1.0" encoding="UTF-8" standalone="yes"?>
-<idPkg:Story xmlns:idPkg="http://ns.adobe.com/AdobeInDesign/idml/1.0/packaging" DOMVersion="20.4">
-\t<Story Self="{story_id}" AppliedTOCStyle="n" UserText="true" IsEndnoteStory="false" TrackChanges="false" StoryTitle="$ID/" AppliedNamedGrid="n">
-\t\t<StoryPreference OpticalMarginAlignment="false" OpticalMarginSize="12" FrameType="TextFrameType" StoryOrientation="Horizontal" StoryDirection="LeftToRightDirection" />
-\t\t<InCopyExportOption IncludeGraphicProxies="true" IncludeAllResources="false" />{''.join(story_content)}
-\t</Story>
-</idPkg:Story>"""
+        return _STORY_TMPL.format(story_id=story_id, content="".join(story_content))
 
     def _escape_xml_content(self, text: str) -> str:
         """Escape XML special characters."""
-        text = text.replace("&", "&amp;")
-        text = text.replace("<", "&lt;")
-        text = text.replace(">", "&gt;")
-        text = text.replace('"', "&quot;")
-        text = text.replace("'", "&apos;")
-        return "".join(char for char in text if ord(char) >= 32 or char in "\n\r\t")
+        return text.translate(_XML_ESCAPE)
 
     """Create a TextFrame XML element for a story"""
 
@@ -375,58 +592,19 @@ class EnhancedIDMLGenerator:
         story_id: str,
         frame_id: str,
         x: float,
-        y: float,
+        y: str,  # preformatted by _textframe_y_str
         width: float,
         height: float,
     ) -> str:
 
-        # Use the exact structure from fixed version analysis
-        anchor_height = height / 2
-        
-        # Fixed version uses specific anchor values for wider frames
-        if width == 523.275590551:  # Fixed version width
-            left_anchor = -254.12598425187792
-            right_anchor = 269.1496062991221
-        else:
-            # Fallback to original calculation
-            left_anchor = -width / 2
-            right_anchor = width / 2
-
-        return f"""<TextFrame Self="{frame_id}" ParentStory="{story_id}" PreviousTextFrame="n" NextTextFrame="n" ContentType="TextType" ParentInterfaceChangeCount="" TargetInterfaceChangeCount="" LastUpdatedInterfaceChangeCount="" OverriddenPageItemProps="" HorizontalLayoutConstraints="FlexibleDimension FixedDimension FlexibleDimension" VerticalLayoutConstraints="FlexibleDimension FixedDimension FlexibleDimension" GradientFillStart="0 0" GradientFillLength="0" GradientFillAngle="0" GradientStrokeStart="0 0" GradientStrokeLength="0" GradientStrokeAngle="0" ItemLayer="uba" Locked="false" LocalDisplaySetting="Default" GradientFillHiliteLength="0" GradientFillHiliteAngle="0" GradientStrokeHiliteLength="0" GradientStrokeHiliteAngle="0" AppliedObjectStyle="ObjectStyle/$ID/[Normal Text Frame]" Visible="true" Name="$ID/" ItemTransform="1 0 0 1 {x} {y}">
-\t\t\t<Properties>
-\t\t\t\t<PathGeometry>
-\t\t\t\t\t<GeometryPathType PathOpen="false">
-\t\t\t\t\t\t<PathPointArray>
-\t\t\t\t\t\t\t<PathPointType Anchor="{left_anchor} -{anchor_height}" LeftDirection="{left_anchor} -{anchor_height}" RightDirection="{left_anchor} -{anchor_height}" />
-\t\t\t\t\t\t\t<PathPointType Anchor="{left_anchor} {anchor_height}" LeftDirection="{left_anchor} {anchor_height}" RightDirection="{left_anchor} {anchor_height}" />
-\t\t\t\t\t\t\t<PathPointType Anchor="{right_anchor} {anchor_height}" LeftDirection="{right_anchor} {anchor_height}" RightDirection="{right_anchor} {anchor_height}" />
-\t\t\t\t\t\t\t<PathPointType Anchor="{right_anchor} -{anchor_height}" LeftDirection="{right_anchor} -{anchor_height}" RightDirection="{right_anchor} -{anchor_height}" />
-\t\t\t\t\t\t</PathPointArray>
-\t\t\t\t\t</GeometryPathType>
-\t\t\t\t</PathGeometry>
-\t\t\t</Properties>
-\t\t\t<TextFramePreference TextColumnCount="1" TextColumnFixedWidth="{width}" TextColumnMaxWidth="0">
-\t\t\t\t<Properties>
-\t\t\t\t\t<InsetSpacing type="list">
-\t\t\t\t\t\t<ListItem type="unit">0</ListItem>
-\t\t\t\t\t\t<ListItem type="unit">0</ListItem>
-\t\t\t\t\t\t<ListItem type="unit">0</ListItem>
-\t\t\t\t\t\t<ListItem type="unit">0</ListItem>
-\t\t\t\t\t</InsetSpacing>
-\t\t\t\t</Properties>
-\t\t\t</TextFramePreference>
-\t\t\t<TextWrapPreference Inverse="false" ApplyToMasterPageOnly="false" TextWrapSide="BothSides" TextWrapMode="None">
-\t\t\t\t<Properties>
-\t\t\t\t\t<TextWrapOffset Top="0" Left="0" Bottom="0" Right="0" />
-\t\t\t\t</Properties>
-\t\t\t</TextWrapPreference>
-\t\t\t<ObjectExportOption EpubType="$ID/" SizeType="DefaultSize" CustomSize="$ID/" PreserveAppearanceFromLayout="PreserveAppearanceDefault" AltTextSourceType="SourceXMLStructure" ActualTextSourceType="SourceXMLStructure" CustomAltText="$ID/" CustomActualText="$ID/" ApplyTagType="TagFromStructure" ImageConversionType="JPEG" ImageExportResolution="Ppi300" GIFOptionsPalette="AdaptivePalette" GIFOptionsInterlaced="true" JPEGOptionsQuality="High" JPEGOptionsFormat="BaselineEncoding" ImageAlignment="AlignLeft" ImageSpaceBefore="0" ImageSpaceAfter="0" UseImagePageBreak="false" ImagePageBreak="PageBreakBefore" CustomImageAlignment="false" SpaceUnit="CssPixel" CustomLayout="false" CustomLayoutType="AlignmentAndSpacing">
-\t\t\t\t<Properties>
-\t\t\t\t\t<AltMetadataProperty NamespacePrefix="$ID/" PropertyPath="$ID/" />
-\t\t\t\t\t<ActualMetadataProperty NamespacePrefix="$ID/" PropertyPath="$ID/" />
-\t\t\t\t</Properties>
-\t\t\t</ObjectExportOption>
-\t\t</TextFrame>"""
+        return _TEXTFRAME_TMPL.format(
+            frame_id=frame_id,
+            story_id=story_id,
+            x=x,
+            y=y,
+            path_points=_textframe_path_points(width, height),
+            width=width,
+        )
 
     """Main function to inject stories and create necessary spreads."""
 
@@ -435,339 +613,306 @@ class EnhancedIDMLGenerator:
     ) -> bool:
 
         try:
-            # Extract IDML
-            extract_dir = tempfile.mkdtemp()
-
-            with zipfile.ZipFile(idml_path, "r") as zip_file:
-                zip_file.extractall(extract_dir)
+            # Every member that differs from the template is kept in memory
+            # and written straight into the final IDML package.
+            entries: Dict[str, bytes] = {}
 
-            # print(f"✓ IDML extraído para: {extract_dir}")
+            # Read the template once; its members are reused when packaging
+            template_members = self._read_template_members()
+            designmap_content = template_members["designmap.xml"][1].decode("utf-8")
 
             # Analyze requirements
             max_page = int(max(story["page_number"] for story in stories))
             required_spreads = self._get_required_spreads(max_page)
 
-            # Check existing spreads directory
-            spreads_dir = os.path.join(extract_dir, "Spreads")
-            existing_spreads = [
-                f for f in os.listdir(spreads_dir) if f.endswith(".xml")
-            ]
+            # print(f"📊 Analysis: {max_page} pages need {required_spreads} spreads")
 
-            # print(f"📊 Analysis: {max_page} pages need {required_spreads} spreads, found {len(existing_spreads)} existing")
+            # Plan every page up front, then group the pages by spread
+            layout = self._plan_layout(max_page)
+            pages_by_spread: List[List[Dict[str, Any]]] = [
+                [] for _ in range(required_spreads)
+            ]
+            for page in layout:
+                pages_by_spread[page["spread_index"]].append(page)
 
-            # Clear existing spreads and create new ones dynamically
-            # print("🧹 Clearing existing spreads for dynamic generation...")
-            for spread_file in existing_spreads:
-                spread_path = os.path.join(spreads_dir, spread_file)
-                os.remove(spread_path)
-                # print(f"✓ Removed template spread: {spread_file}")
+            # TextFrames of every page, grouped by the spread they belong to
+            textframes_by_spread = self._plan_textframes(stories, required_spreads)
 
-            # Create ALL spreads dynamically based on fixed structure analysis
+            # Create ALL spreads dynamically based on fixed structure analysis.
+            # Template spreads are left out by _read_template_members.
             new_spreads = []
-            for spread_idx in range(required_spreads):
-                spread_id = self._generate_spread_id()
-                self.spread_counter += 1
+            for spread_idx, pages_in_spread in enumerate(pages_by_spread):
+                spread_id = self._next_id("spread")
                 spread_filename = f"Spread_{spread_id}.xml"
-                spread_path = os.path.join(spreads_dir, spread_filename)
 
-                # Determine pages for this spread based on fixed structure
-                if spread_idx == 0:
-                    # First spread: page 1 only
-                    pages_in_spread = [1]
-                else:
-                    # Additional spreads: calculate pages
-                    first_page = (spread_idx * 2)
-                    second_page = first_page + 1 if first_page + 1 <= max_page else None
-                    
-                    pages_in_spread = [first_page]
-                    if second_page:
-                        pages_in_spread.append(second_page)
-
-                # Create spread XML
+                # Create spread XML, TextFrames included
                 spread_xml = self._create_spread_xml(
-                    spread_id, spread_idx, pages_in_spread
+                    spread_id,
+                    spread_idx,
+                    pages_in_spread,
+                    textframes_by_spread[spread_idx],
                 )
 
-                with open(spread_path, "w", encoding="utf-8") as f:
-                    f.write(spread_xml)
+                entries[f"Spreads/{spread_filename}"] = spread_xml.encode("utf-8")
 
                 new_spreads.append(spread_filename)
                 # print(f"✅ Created spread: {spread_filename} (pages {pages_in_spread})")
 
-            # Update designmap for all new spreads
-            self._update_designmap_for_new_spreads(extract_dir, new_spreads)
-
             # Create and inject stories
-            self._inject_stories_to_extracted_idml(extract_dir, stories)
-
-            # Add TextFrames to spreads
-            self._add_textframes_to_spreads(extract_dir, stories)
+            self._inject_stories(entries, stories)
 
-            # Repackage IDML
-            with zipfile.ZipFile(idml_path, "w", zipfile.ZIP_DEFLATED) as zip_file:
-                for root, dirs, files in os.walk(extract_dir):
-                    for file in files:
-                        file_path = os.path.join(root, file)
-                        arc_name = os.path.relpath(file_path, extract_dir)
-                        zip_file.write(file_path, arc_name)
+            # Register new spreads and stories in a single designmap rewrite
+            designmap_content = self._rewrite_designmap(
+                designmap_content, new_spreads, stories
+            )
+            entries["designmap.xml"] = designmap_content.encode("utf-8")
 
-            # Cleanup
-            shutil.rmtree(extract_dir)
+            # Package IDML
+            self._write_idml_zip(idml_path, template_members, entries)
             print("✅ IDML gerado")
 
             return True
 
-        except Exception as e:
+        except _GENERATION_ERRORS as e:
             print(f"❌ Erro na geração dinâmica: {e}")
-            import traceback
-
-            traceback.print_exc()
-            return False
-
-    def _inject_stories_to_extracted_idml(
-        self, extract_dir: str, stories: List[Dict[str, str]]
-    ) -> bool:
-        """Inject story files into extracted IDML."""
-        try:
-            stories_dir = os.path.join(extract_dir, "Stories")
-            os.makedirs(stories_dir, exist_ok=True)
-
-            # Create story files
-            for story_data in stories:
-                story_filename = f"Story_{story_data['story_id']}.xml"
-                story_path = os.path.join(stories_dir, story_filename)
-
-                with open(story_path, "w", encoding="utf-8") as f:
-                    f.write(story_data["story_xml"])
-
-                # print(f"✓ Story created: {story_filename}")
-
-            # Update designmap for stories
-            self._update_designmap_for_stories(extract_dir, stories)
-
-            return True
-
-        except Exception as e:
-            print(f"❌ Erro ao injetar stories: {e}")
+            if self.debug:
+                traceback.print_exc()
             return False
 
-    def _update_designmap_for_stories(
-        self, extract_dir: str, stories: List[Dict[str, str]]
-    ) -> bool:
-        """Update designmap.xml with story references."""
-        try:
-            designmap_path = os.path.join(extract_dir, "designmap.xml")
-
-            with open(designmap_path, "r", encoding="utf-8") as f:
-                designmap_content = f.read()
-
-            # Add story entries
-            story_entries = []
-            for story_data in stories:
-                story_filename = f"Story_{story_data['story_id']}.xml"
-                story_entry = f'\n\t<idPkg:Story src="Stories/{story_filename}" />'
-                story_entries.append(story_entry)
-
-            # Insert before closing tag
-            if "</Document>" in designmap_content:
-                insert_point = designmap_content.rfind("</Document>")
-                new_content = (
-                    designmap_content[:insert_point]
-                    + "".join(story_entries)
-                    + "\n"
-                    + designmap_content[insert_point:]
+    def _read_template_members(self) -> Dict[str, Tuple[zipfile.ZipInfo, bytes]]:
+        """Template members in archive order, read in a single pass."""
+        with zipfile.ZipFile(self.base_idml_path, "r") as template_zip:
+            return {
+                info.filename: (info, template_zip.read(info))
+                for info in template_zip.infolist()
+                # Template spreads are always replaced by the generated ones
+                if not info.filename.startswith("Spreads/")
+            }
+
+    def _write_idml_zip(
+        self,
+        output_path: str,
+        template_members: Dict[str, Tuple[zipfile.ZipInfo, bytes]],
+        entries: Dict[str, bytes],
+    ) -> None:
+        """Write the IDML package: untouched template members plus generated entries."""
+        # Assemble the whole package in memory; IDMLs are only a few MB
+        buffer = io.BytesIO()
+        with zipfile.ZipFile(
+            buffer, "w", zipfile.ZIP_DEFLATED, compresslevel=self.compresslevel
+        ) as zip_file:
+            for name, (info, data) in template_members.items():
+                if name in entries:
+                    continue
+                # Keeps the template's compression method (mimetype stays stored)
+                zip_file.writestr(info, data, compresslevel=self.compresslevel)
+
+            for name, data in entries.items():
+                # Small members are stored: deflate would barely shrink them
+                zip_file.writestr(
+                    name,
+                    data,
+                    compress_type=(
+                        zipfile.ZIP_STORED if len(data) < _STORED_MAX_SIZE else None
+                    ),
                 )
 
-                with open(designmap_path, "w", encoding="utf-8") as f:
-                    f.write(new_content)
-
-                # print(f"✅ Updated designmap.xml with {len(stories)} story references")
-                return True
-
-            return False
-
-        except Exception as e:
-            print(f"❌ Error updating designmap for stories: {e}")
-            return False
-
-    """Add TextFrames to the appropriate created spreads."""
-
-    def _add_textframes_to_spreads(
-        self, extract_dir: str, stories: List[Dict[str, str]]
-    ) -> bool:
+        # Write once next to the destination and publish only once complete
+        tmp_path = output_path + ".tmp"
         try:
-            spreads_dir = os.path.join(extract_dir, "Spreads")
-
-            # Organize stories by page
-            pages_stories = {}
-            for story_data in stories:
-                page_num = story_data["page_number"]
-                if page_num not in pages_stories:
-                    pages_stories[page_num] = []
-                pages_stories[page_num].append(story_data)
-
-            # Calculate required spreads for this content
-            max_page = int(max(story["page_number"] for story in stories))
-            required_spreads = self._get_required_spreads(max_page)
-            
-            # Get all dynamically created spread files in creation order
-            spread_files = []
-            for spread_idx in range(required_spreads):
-                # Recreate the spread filename based on the same logic used in creation
-                if spread_idx == 0:
-                    spread_id = "ucf"  # First spread ID
-                elif spread_idx == 1:
-                    spread_id = "u109"  # Second spread ID  
-                else:
-                    spread_id = f"u{100 + spread_idx + 1:03d}"  # Additional spreads
-                
-                spread_filename = f"Spread_{spread_id}.xml"
-                spread_files.append(spread_filename)
-
-            # print(f"📄 Distributing TextFrames across {len(spread_files)} dynamic spreads")
+            with open(tmp_path, "wb") as out_file:
+                out_file.write(buffer.getbuffer())
+        except BaseException:
+            # Never leave a half-written package behind
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+
+        os.replace(tmp_path, output_path)
+
+    def _inject_stories(
+        self, entries: Dict[str, bytes], stories: List[Dict[str, str]]
+    ) -> None:
+        """Inject story files into the IDML entries."""
+        # Create story files
+        for story_data in stories:
+            story_filename = f"Story_{story_data['story_id']}.xml"
+            entries[f"Stories/{story_filename}"] = story_data["story_xml"].encode("utf-8")
+
+            # print(f"✓ Story created: {story_filename}")
+
+    """Build the TextFrames of each page for the spread that will contain it."""
+
+    def _plan_textframes(
+        self, stories: List[Dict[str, str]], spread_count: int
+    ) -> List[List[str]]:
+        textframes_by_spread: List[List[str]] = [[] for _ in range(spread_count)]
+
+        # Organize stories by page
+        pages_stories: DefaultDict[int, List[Dict[str, str]]] = defaultdict(list)
+        for story_data in stories:
+            pages_stories[story_data["page_number"]].append(story_data)
+
+        # print(f"📄 Distributing TextFrames across {spread_count} dynamic spreads")
+
+        # Add TextFrames to each page
+        for page_num, page_stories in pages_stories.items():
+            # Calculate which spread this page belongs to based on actual spread structure
+            # Spread 0: Page 1 only, Spread 1: Page 2-3, Spread 2: Pages 4-5, etc.
+            if page_num == 1:
+                spread_index = 0
+            elif page_num == 2:
+                spread_index = 1
+            else:
+                # For pages 3+, they go to spread 1 (pages 2-3 together)
+                spread_index = 1
 
-            # Add TextFrames to each page
-            for page_num, page_stories in pages_stories.items():
-                # Calculate which spread this page belongs to based on actual spread structure
-                # Spread 0: Page 1 only, Spread 1: Page 2-3, Spread 2: Pages 4-5, etc.
+            if spread_index < spread_count:
+                # Calculate TextFrame X position based on fixed structure analysis
                 if page_num == 1:
-                    spread_index = 0
+                    frame_x = 290.1259842518779  # Page 1: center/right position
                 elif page_num == 2:
-                    spread_index = 1
+                    frame_x = -297.6377952754999  # Page 2: left side of spread
+                elif page_num == 3:
+                    frame_x = 290.1259842518779   # Page 3: right side of spread (same as page 1)
                 else:
-                    # For pages 3+, they go to spread 1 (pages 2-3 together)
-                    spread_index = 1
-
-                if spread_index < len(spread_files):
-                    spread_file = spread_files[spread_index]
-                    spread_path = os.path.join(spreads_dir, spread_file)
-
-                    # Calculate TextFrame X position based on fixed structure analysis
-                    if page_num == 1:
-                        frame_x = 290.1259842518779  # Page 1: center/right position
-                    elif page_num == 2:
-                        frame_x = -297.6377952754999  # Page 2: left side of spread
-                    elif page_num == 3:
-                        frame_x = 290.1259842518779   # Page 3: right side of spread (same as page 1)
-                    else:
-                        # For additional pages, alternate based on page position
-                        if page_num % 2 == 0:  # Even pages (left side)
-                            frame_x = -297.6377952754999
-                        else:  # Odd pages (right side)
-                            frame_x = 290.1259842518779
-
-                    # Read spread
-                    with open(spread_path, "r", encoding="utf-8") as f:
-                        spread_content = f.read()
-
-                    # Create TextFrames - one per story with vertical spacing
-                    textframes = []
-                    for story_idx, story_data in enumerate(page_stories):
-                        story_id = story_data["story_id"]
-                        frame_id = self._generate_textframe_id()
-
-                        # Calculate Y position based on story index and page
-                        frame_y = self._calculate_textframe_y_position(
-                            page_num, story_idx
-                        )
-
-                        # Use frame dimensions from template
-                        textframe_xml = self._create_textframe_for_story(
-                            story_id,
-                            frame_id,
-                            frame_x,
-                            frame_y,
-                            self.frame_width,
-                            self.frame_height,
-                        )
-                        textframes.append(textframe_xml)
-
-                    # Insert TextFrames into spread
-                    if "</Spread>" in spread_content:
-                        insert_point = spread_content.rfind("</Spread>")
-                        new_content = (
-                            spread_content[:insert_point]
-                            + "\n\t\t"
-                            + "\n\t\t".join(textframes)
-                            + "\n\t"
-                            + spread_content[insert_point:]
-                        )
-
-                        with open(spread_path, "w", encoding="utf-8") as f:
-                            f.write(new_content)
+                    # For additional pages, alternate based on page position
+                    if page_num % 2 == 0:  # Even pages (left side)
+                        frame_x = -297.6377952754999
+                    else:  # Odd pages (right side)
+                        frame_x = 290.1259842518779
+
+                # Create TextFrames - one per story with vertical spacing
+                textframes = []
+                for story_idx, story_data in enumerate(page_stories):
+                    story_id = story_data["story_id"]
+                    frame_id = self._generate_textframe_id()
+
+                    # Calculate Y position based on story index and page
+                    frame_y = self._textframe_y_str(
+                        page_num, story_idx
+                    )
 
-                    print(
-                        f"  - Adicionou {len(textframes)} caixas de texto à página {page_num}"
+                    # Use frame dimensions from template
+                    textframe_xml = self._create_textframe_for_story(
+                        story_id,
+                        frame_id,
+                        frame_x,
+                        frame_y,
+                        self.frame_width,
+                        self.frame_height,
                     )
-                else:
-                    print(f"⚠️  Não há spread disponível para a página {page_num}")
+                    textframes.append(textframe_xml)
 
-            return True
+                # One block per page, in page order within the spread
+                textframes_by_spread[spread_index].append(
+                    "\n\t\n\t\t" + "\n\t\t".join(textframes)
+                )
 
-        except Exception as e:
-            print(f"❌ Erro ao adicionar TextFrames: {e}")
-            import traceback
+                print(
+                    f"  - Adicionou {len(textframes)} caixas de texto à página {page_num}"
+                )
+            else:
+                print(f"⚠️  Não há spread disponível para a página {page_num}")
 
-            traceback.print_exc()
-            return False
+        return textframes_by_spread
 
     def _calculate_textframe_y_position(self, page_num: int, story_index: int) -> float:
         """Calculate Y position for TextFrame based on fixed structure analysis."""
         # Use CONSISTENT Y positions for ALL pages - this was the main issue!
         # The Y positions should be the same regardless of page number
-        base_positions = [
-            -326.83464566890945,
-            -210.61417322872836,
-            -94.39370078854728,
-            21.826771651633806,
-            138.0472440918149,
-            254.26771653199575,  # Extra positions for more sections
-        ]
-
         # Return the position for this story index, or calculate if beyond predefined
-        if story_index < len(base_positions):
-            return base_positions[story_index]
+        if story_index < len(_BASE_Y_LIST):
+            return _BASE_Y_LIST[story_index]
         else:
             # If more stories than predefined positions, continue the pattern
-            last_pos = base_positions[-1]
+            last_pos = _BASE_Y_LIST[-1]
             additional_spacing = 140
             return last_pos + (
-                additional_spacing * (story_index - len(base_positions) + 1)
+                additional_spacing * (story_index - len(_BASE_Y_LIST) + 1)
             )
 
+    def _textframe_y_str(self, page_num: int, story_index: int) -> str:
+        """TextFrame Y position already formatted for ItemTransform."""
+        if story_index < len(_BASE_Y_STR):
+            return _BASE_Y_STR[story_index]
+
+        y_str = _extra_y_str_cache.get(story_index)
+        if y_str is None:
+            y_str = _extra_y_str_cache[story_index] = repr(
+                self._calculate_textframe_y_position(page_num, story_index)
+            )
+        return y_str
+
+    def _validate_pages(self, pages: Any) -> None:
+        """Check the shape of the pages list, raising ValueError on malformed input."""
+        if not isinstance(pages, (list, tuple)):
+            raise ValueError("'pages' deve ser uma lista de páginas")
+
+        for page_num, page in enumerate(pages, 1):
+            if not isinstance(page, dict):
+                raise ValueError(f"Página {page_num}: esperado um objeto")
+
+            sections = page.get("sections") or ()
+            if not isinstance(sections, (list, tuple)):
+                raise ValueError(f"Página {page_num}: 'sections' deve ser uma lista")
+
+            for section_num, section in enumerate(sections, 1):
+                if not isinstance(section, dict):
+                    raise ValueError(
+                        f"Página {page_num}, seção {section_num}: esperado um objeto"
+                    )
+                for key in ("title", "text"):
+                    if not isinstance(section.get(key, ""), str):
+                        raise ValueError(
+                            f"Página {page_num}, seção {section_num}: '{key}' deve ser texto"
+                        )
+
     """
     Main function to generate enhanced IDML with exact number of pages from JSON.
     """
 
     def generate_file(
-        self, json_data: Dict[str, Any], base_name: str = "enhanced"
+        self,
+        json_data: Union[Dict[str, Any], Sequence[Dict[str, Any]]],
+        base_name: str = "enhanced",
     ) -> bool:
 
         try:
-            # Get output path
-            output_path = self._get_next_output_filename(base_name)
+            # Accept the full JSON document or its "pages" list directly
+            if isinstance(json_data, dict):
+                pages = json_data.get("pages") or ()
+            else:
+                pages = json_data
+
+            # Reject malformed pages/sections before generating anything
+            self._validate_pages(pages)
 
             # Analyze input - Generate exactly the number of pages in JSON
-            total_pages = len(json_data.get("pages", []))
+            total_pages = len(pages)
 
             # Validate JSON structure
             if total_pages == 0:
                 print("❌ Não foi possível encontrar páginas no JSON")
                 return False
 
-            # Copy new template
-            base_template = self._find_base_template()
-            shutil.copy2(base_template, output_path)
-            # print(f"✓ Template copiado (template.idml)")
+            # Get output path
+            output_path = self._get_next_output_filename(base_name)
+
+            # Locate template once (its members are copied while packaging)
+            if self.base_idml_path is None:
+                self.base_idml_path = self._find_base_template()
 
             # Create stories - one per page (first section only for now)
-            stories = self._create_stories_from_pages(json_data)
+            stories = self._create_stories_from_pages(pages)
             print(f"✅ Criou {len(stories)} stories em {total_pages} páginas")
 
             # Enhanced generation with exact page count
             success = self._inject_stories_and_create_spreads(output_path, stories)
 
             if success:
+                # Only a published package advances the persisted sequence
+                self._write_output_seq(base_name)
                 print(f" - Documento .IDML gerado: {output_path}")
                 print(f" - Gerou {total_pages} páginas")
                 return True
@@ -775,66 +920,42 @@ class EnhancedIDMLGenerator:
                 print("❌ Não foi possível gerar o documento .IDML")
                 return False
 
-        except Exception as e:
+        except _GENERATION_ERRORS as e:
             print(f"❌ Error in enhanced generation: {e}")
-            import traceback
-
-            traceback.print_exc()
+            if self.debug:
+                traceback.print_exc()
             return False
 
 
-def main():
-    import sys
-    
-    print("🚀 Gerando documento .IDML")
-
-    # Parse command line arguments
-    test_type = "one"  # default
-    if len(sys.argv) > 1:
-        arg = sys.argv[1].lower()
-        if arg in ["-one", "-two", "-three", "-four"]:
-            test_type = arg[1:]  # remove the dash
-        else:
-            print(f"❌ Argumento inválido: {arg}")
-            print("Use: python idml_generator.py [-one|-two|-three|-four]")
-            return 1
-
-    # Map test types to JSON files
-    json_files = {
-        "one": "onePage.json",
-        "two": "twoPages.json", 
-        "three": "threePages.json",
-        "four": "fourPages.json"
-    }
-    
+def _generate_one(test_type: str) -> int:
+    """Generate the document of one test type and return its exit code."""
     # Load test JSON from examples directory
-    json_filename = json_files[test_type]
-    json_paths = [
-        f"examples/{json_filename}",
-        f"../examples/{json_filename}",
-        f"src/examples/{json_filename}"
-    ]
-    
-    json_file = None
-    for path in json_paths:
-        if os.path.exists(path):
-            json_file = path
-            break
+    json_filename = EXAMPLE_JSON_FILES[test_type]
+    json_file = _json_path_cache.get(test_type)
+    if json_file is None:
+        for search_dir in JSON_SEARCH_DIRS:
+            path = search_dir / json_filename
+            if path.is_file():
+                json_file = _json_path_cache[test_type] = path
+                break
 
     if not json_file:
         print(f"❌ Não foi possível encontrar o arquivo JSON: {json_filename}")
-        print(f"Procurado em: {json_paths}")
+        print(f"Procurado em: {[os.fspath(d / json_filename) for d in JSON_SEARCH_DIRS]}")
         return 1
 
-    with open(json_file, "r", encoding="utf-8") as f:
-        json_data = json.load(f)
+    # Both parsers accept UTF-8 bytes directly
+    with open(json_file, "rb") as f:
+        json_data = _json_loads(f.read())
+
+    pages = json_data.get("pages") or ()
 
     print(f"✅ Arquivo JSON carregado: {json_file}")
-    print(f"📄 Tipo de teste: {test_type} ({len(json_data.get('pages', []))} páginas)")
+    print(f"📄 Tipo de teste: {test_type} ({len(pages)} páginas)")
 
     # Generate enhanced IDML
     generator = EnhancedIDMLGenerator()
-    success = generator.generate_file(json_data, f"document-{test_type}")
+    success = generator.generate_file(pages, f"document-{test_type}")
 
     if success:
         return 0
@@ -843,5 +964,57 @@ def main():
         return 1
 
 
+def _generate_one_logged(test_type: str) -> Tuple[int, str]:
+    """Run _generate_one capturing its output, so parallel logs don't interleave."""
+    log = io.StringIO()
+    with contextlib.redirect_stdout(log):
+        exit_code = _generate_one(test_type)
+    return exit_code, log.getvalue()
+
+
+def main():
+    import sys
+    
+    print("🚀 Gerando documento .IDML")
+
+    usage = "Use: python idml_generator.py [-one|-two|-three|-four ...] [--parallel N]"
+
+    # Parse command line arguments
+    test_types = []
+    workers = 1
+    args = iter(sys.argv[1:])
+    for arg in args:
+        arg = arg.lower()
+        if arg == "--parallel":
+            value = next(args, "")
+            if not value.isdigit() or int(value) < 1:
+                print(f"❌ Valor inválido para --parallel: {value}")
+                print(usage)
+                return 1
+            workers = int(value)
+        elif arg in ["-one", "-two", "-three", "-four"]:
+            test_types.append(arg[1:])  # remove the dash
+        else:
+            print(f"❌ Argumento inválido: {arg}")
+            print(usage)
+            return 1
+
+    # Each test type is generated once; "one" is the default
+    test_types = list(dict.fromkeys(test_types)) or ["one"]
+
+    if workers > 1 and len(test_types) > 1:
+        # One process per document: generation is CPU-bound and holds the GIL
+        with ProcessPoolExecutor(max_workers=min(workers, len(test_types))) as executor:
+            results = []
+            # Each worker's log is printed whole, in argument order
+            for exit_code, log in executor.map(_generate_one_logged, test_types):
+                print(log, end="")
+                results.append(exit_code)
+    else:
+        results = [_generate_one(test_type) for test_type in test_types]
+
+    return max(results)
+
+
 if __name__ == "__main__":
-    exit(main())
\ No newline at end of file
+    exit(main())